@@ -0,0 +1,17 @@
+"""Support running dsync commands without actually transferring data."""
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# ContextVar rather than a module global: .get() is a single C-level call and
+# the flag stays correct if syncs ever fan out across threads or tasks.
+DRYRUN: ContextVar[bool] = ContextVar("DRYRUN", default=False)
+
+
+@contextmanager
+def dry_run():
+    """Run the enclosed code without actually transferring any data."""
+    token = DRYRUN.set(True)
+    try:
+        yield
+    finally:
+        DRYRUN.reset(token)
@@ -1,7 +1,10 @@
 """Define dsync database models."""
 import os
 import os.path as op
-from datetime import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar, copy_context
+from datetime import datetime, timedelta
 from functools import lru_cache, wraps
 
 from sqlalchemy import (
@@ -9,15 +12,55 @@ from sqlalchemy import (
     Column,
     DateTime,
     ForeignKey,
+    Index,
     String,
     create_engine,
+    event,
+    func,
+    tuple_,
+    update,
 )
 from sqlalchemy.orm import Session, declarative_base, relationship
+from sqlalchemy.pool import StaticPool
 
+from .dry_run import DRYRUN
 from .transfer import get_transfer_protocol
 
 Base = declarative_base()
 
+# Cached results of DataStore.get_connection, keyed by (name, type, link).
+_connection_cache = {}
+_CONNECTION_TTL = 30  # seconds
+
+# Root directory containing the local version of all datasets (computed once).
+_DATA_ROOT = op.expanduser("~/Work/data") + "/"
+
+# Per-process cache of computed edit times, keyed on dataset name and
+# invalidated through the mtime of the dataset's top-level directory.
+_latest_edit_cache = {}
+
+
+def _max_mtime(path):
+    """Return the maximum mtime of any file underneath `path` (0 if there are none)."""
+    max_mtime = 0
+    to_visit = [path]
+    while len(to_visit) > 0:
+        try:
+            with os.scandir(to_visit.pop()) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            to_visit.append(entry.path)
+                        else:
+                            mtime = entry.stat().st_mtime
+                            if mtime > max_mtime:
+                                max_mtime = mtime
+                    except FileNotFoundError:
+                        continue
+        except FileNotFoundError:
+            continue
+    return max_mtime
+
 
 class DataStore(Base):
     """Data storage location (ssh/disc)."""
@@ -32,6 +75,7 @@ class DataStore(Base):
         "ToSync",
         back_populates="store",
         cascade="all",
+        lazy="selectin",
     )
 
     def __repr__(
@@ -47,9 +91,32 @@ class DataStore(Base):
         Get the best connection to the DataStore.
 
         Returns None if no connection is available.
+        The result is cached for `_CONNECTION_TTL` seconds,
+        so repeated probes within one CLI run do not spawn new subprocesses.
         """
+        key = (self.name, self.type, self.link)
+        cached = _connection_cache.get(key)
+        if cached is not None and time.monotonic() - cached[0] < _CONNECTION_TTL:
+            return cached[1]
         transfer = get_transfer_protocol(self)
-        return transfer if transfer.setup_connection() else None
+        result = transfer if transfer.setup_connection() else None
+        _connection_cache[key] = (time.monotonic(), result)
+        return result
+
+
+def get_connections(stores):
+    """
+    Probe the connection to each of the given data stores in parallel.
+
+    Returns a dictionary from store name to connection (None if unavailable).
+    The probes are latency-bound, so running them concurrently means the
+    total wait is set by the slowest store rather than the sum of all of them.
+    """
+    if len(stores) == 0:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(len(stores), 8)) as executor:
+        links = executor.map(DataStore.get_connection, stores)
+        return {store.name: link for store, link in zip(stores, links)}
 
 
 class Dataset(Base):
@@ -68,8 +135,10 @@ class Dataset(Base):
         "ToSync",
         back_populates="dataset",
         cascade="all",
+        lazy="selectin",
     )
     latest_edit = Column(DateTime, nullable=True)
+    latest_edit_refreshed_at = Column(DateTime, nullable=True)
 
     @property
     def local_path(
@@ -80,32 +149,90 @@ class Dataset(Base):
 
         The data should exist in this location unless `self.archive` is True.
         """
-        return op.join(op.expanduser("~/Work/data"), self.name) + "/"
+        return _DATA_ROOT + self.name + "/"
 
     def update_latest_edit(
         self,
     ):
         """Update time of latest edit, presuming the local version is up to date."""
         max_mtime = 0
-        for dirname, _, files in os.walk(self.local_path):
-            for fname in files:
-                full_path = os.path.join(dirname, fname)
-                try:
-                    mtime = os.stat(full_path).st_mtime
-                    if mtime > max_mtime:
-                        max_mtime = mtime
-                except FileNotFoundError:
-                    continue
+        top_level_dirs = []
+        try:
+            with os.scandir(self.local_path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            top_level_dirs.append(entry.path)
+                        else:
+                            max_mtime = max(max_mtime, entry.stat().st_mtime)
+                    except FileNotFoundError:
+                        continue
+        except FileNotFoundError:
+            pass
+        if len(top_level_dirs) > 0:
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                max_mtime = max(
+                    [max_mtime] + list(executor.map(_max_mtime, top_level_dirs))
+                )
         self.latest_edit = datetime.fromtimestamp(max_mtime)
+        self.latest_edit_refreshed_at = datetime.now()
+
+    def refresh_latest_edit(self, max_age=timedelta(hours=1)):
+        """
+        Update time of latest edit, unless it was already refreshed recently.
+
+        When a refresh is due but the top-level directory's mtime has not
+        changed since the last full walk in this process, the previous
+        result is reused instead of walking the whole tree again.
+        """
+        if (
+            self.latest_edit is not None
+            and self.latest_edit_refreshed_at is not None
+            and datetime.now() - self.latest_edit_refreshed_at <= max_age
+        ):
+            return
+        try:
+            top_mtime = os.stat(self.local_path).st_mtime
+        except OSError:
+            top_mtime = None
+        cached = _latest_edit_cache.get(self.name)
+        if top_mtime is not None and cached is not None and cached[0] == top_mtime:
+            self.latest_edit = cached[1]
+            self.latest_edit_refreshed_at = datetime.now()
+            return
+        self.update_latest_edit()
+        if top_mtime is not None:
+            _latest_edit_cache[self.name] = (top_mtime, self.latest_edit)
+
+    @property
+    def syncs_by_store(self):
+        """Dictionary mapping store name to the sync objects of this dataset."""
+        return {to_sync.store_name: to_sync for to_sync in self.syncs}
 
     def all_syncs(self, session):
         """Return dictionary with all sync objects related with this DataSet."""
-        existing_syncs = {tosync.store.name: tosync for tosync in self.syncs}
-        for store in session.query(DataStore).all():
-            if store.name not in existing_syncs and store.is_archive:
-                new_sync = ToSync(dataset=self, store=store)
-                session.add(new_sync)
-                existing_syncs[store.name] = new_sync
+        existing_syncs = self.syncs_by_store
+        if "archive_stores" not in session.info:
+            # Archives rarely change within a run, so query them once per session.
+            session.info["archive_stores"] = (
+                session.query(DataStore).filter_by(is_archive=True).all()
+            )
+        missing = [
+            store
+            for store in session.info["archive_stores"]
+            if store.name not in existing_syncs
+        ]
+        if len(missing) > 0:
+            # Single executemany INSERT instead of unit-of-work flushes per row.
+            session.bulk_insert_mappings(
+                ToSync,
+                [
+                    {"dataset_name": self.name, "store_name": store.name}
+                    for store in missing
+                ],
+            )
+            session.expire(self, ["syncs"])
+            existing_syncs = self.syncs_by_store
         return existing_syncs
 
     def __repr__(
@@ -114,26 +241,47 @@ class Dataset(Base):
         """Represent dataset as string."""
         return f"Dataset(name={self.name})"
 
-    def sync(self, session, store=None):
-        """Sync this dataset with the given store links."""
+    def sync(self, session, store=None, verbose=False, workers=None):
+        """
+        Sync this dataset with the given store links.
+
+        Set `workers` above 1 to shard each transfer over that many
+        concurrent rsyncs.
+        """
+        syncs_by_store = self.syncs_by_store
         if self.primary is not None and store is None:
-            primary_sync = session.query(ToSync).get((self.name, self.primary_name))
-            if primary_sync.sync() != 0:
+            if syncs_by_store[self.primary_name].sync(verbose=verbose, workers=workers) != 0:
                 return 1
         all_syncs = self.all_syncs(session)
         if store is not None:
             if store not in all_syncs:
                 return 1
-            result = all_syncs[store].sync()
-            if result == 0 and self.primary is not None:
+            result = all_syncs[store].sync(verbose=verbose, workers=workers)
+            if result == 0 and self.primary is not None and not DRYRUN.get():
                 all_syncs[store].last_sync = all_syncs[self.primary.name].last_sync
             return result
         else:
-            return_codes = []
-            for to_sync in self.syncs:
-                if to_sync.store.name != store:
-                    return_codes.append(to_sync.sync())
-            return 1 if len(return_codes) == 0 else min(abs(x) for x in return_codes)
+            best = None
+            synced = []
+            for to_sync in syncs_by_store.values():
+                if to_sync.store.name == store:
+                    continue
+                rc = abs(to_sync.sync(record=False, verbose=verbose, workers=workers))
+                if rc == 0:
+                    synced.append((to_sync.dataset_name, to_sync.store_name))
+                if best is None or rc < best:
+                    best = rc
+            mark_synced(session, synced)
+            return 1 if best is None else best
+
+
+# Serves the case-insensitive prefix match used by shell completion.
+Index("ix_dataset_lower_name", func.lower(Dataset.name))
+# Serves lookups of all datasets with a given primary store.
+Index("ix_dataset_primary_name", Dataset.primary_name)
+# Serve the archived/is_archive filters used by listing, syncing and completion.
+Index("ix_dataset_archived", Dataset.archived)
+Index("ix_data_store_is_archive", DataStore.is_archive)
 
 
 class ToSync(Base):
@@ -152,7 +300,7 @@ class ToSync(Base):
     store_name = Column(
         String, ForeignKey("data_store.name"), nullable=False, primary_key=True
     )
-    store = relationship("DataStore", back_populates="syncs")
+    store = relationship("DataStore", back_populates="syncs", lazy="joined")
     last_sync = Column(DateTime)
 
     def __repr__(
@@ -166,13 +314,19 @@ class ToSync(Base):
         self,
     ):
         """Path to dataset on data store."""
-        if self.store.type == "disc":
-            return f"/Volumes/{self.store_name}/data-archive/{self.dataset_name}/"
-        if self.store.type == "ssh":
-            return f"/Volumes/{self.store_name}/data-archive/{self.dataset_name}/"
+        # disc and ssh stores currently share the same layout
+        return f"/Volumes/{self.store_name}/data-archive/{self.dataset_name}/"
 
-    def sync(self, link=None):
-        """Sync data in dataset from/to the store."""
+    def sync(self, link=None, record=True, verbose=False, workers=None):
+        """
+        Sync data in dataset from/to the store.
+
+        Set `record` to False to skip updating `last_sync` on success,
+        for callers that record many successful syncs in a single UPDATE
+        through `mark_synced`.
+        Set `workers` above 1 to shard the transfer over that many
+        concurrent rsyncs.
+        """
         if self.dataset.archived:
             raise ValueError("Cannot sync an archived dataset.")
         if link is None:
@@ -183,34 +337,183 @@ class ToSync(Base):
         from_local = self.store != self.dataset.primary
         if not from_local and self.store.is_archive:
             raise ValueError("Primary data store should not be an archive.")
-        rc = link.sync(self.dataset.name, from_local=from_local)
-        if rc == 0:
+        if workers is not None and workers > 1:
+            rc = link.sync_parallel(
+                self.dataset.name, from_local=from_local, workers=workers, verbose=verbose
+            )
+        else:
+            rc = link.sync(self.dataset.name, from_local=from_local, verbose=verbose)
+        if rc == 0 and record and not DRYRUN.get():
             self.last_sync = datetime.now()
         return rc
 
 
+# The composite primary key already indexes lookups by dataset_name; this
+# covers the reverse direction of finding all syncs to a given store.
+Index("ix_to_sync_store_name", ToSync.store_name)
+
+
+def sync_datasets(session, datasets, verbose=False):
+    """
+    Sync many datasets, batching the outgoing transfers per data store.
+
+    Each dataset with a primary is first brought up to date from it; the
+    remaining transfers are then grouped by store so that every remote
+    receives one batch of rsync commands (`TransferProtocol.sync_many`)
+    rather than paying the connection overhead once per dataset.
+    """
+    per_store = {}
+    for dataset in datasets:
+        if dataset.primary is not None:
+            if dataset.syncs_by_store[dataset.primary_name].sync(verbose=verbose) != 0:
+                continue
+        for to_sync in dataset.all_syncs(session).values():
+            if to_sync.store_name == dataset.primary_name:
+                continue
+            per_store.setdefault(to_sync.store_name, []).append(to_sync)
+    links = {
+        store_name: to_syncs[0].store.get_connection()
+        for store_name, to_syncs in per_store.items()
+    }
+    available = [store_name for store_name, link in links.items() if link is not None]
+    synced = []
+    if len(available) > 0:
+        # Transfers to distinct stores are independent and network-bound, so
+        # they run concurrently; one batch per store keeps each remote at a
+        # single rsync at a time. Workers only touch the transfer layer --
+        # the session is updated afterwards on this thread. Each task runs
+        # in a copy of the calling context, since context variables (the
+        # DRYRUN flag) do not propagate to pool threads by themselves.
+        with ThreadPoolExecutor(max_workers=min(len(available), 4)) as executor:
+            futures = {
+                store_name: executor.submit(
+                    copy_context().run,
+                    links[store_name].sync_many,
+                    [to_sync.dataset_name for to_sync in per_store[store_name]],
+                    verbose=verbose,
+                )
+                for store_name in available
+            }
+        for store_name, future in futures.items():
+            results = future.result()
+            synced.extend(
+                (to_sync.dataset_name, to_sync.store_name)
+                for to_sync in per_store[store_name]
+                if results.get(to_sync.dataset_name) == 0
+            )
+    mark_synced(session, synced)
+
+
+def mark_synced(session, pairs, when=None):
+    """Record successful syncs for the (dataset, store) name pairs in one UPDATE."""
+    if len(pairs) == 0:
+        return
+    if DRYRUN.get():
+        # rsync --dry-run also exits 0; a dry run must not make an
+        # archive look up to date (`archive` trusts these timestamps).
+        return
+    if when is None:
+        when = datetime.now()
+    session.execute(
+        update(ToSync)
+        .where(tuple_(ToSync.dataset_name, ToSync.store_name).in_(pairs))
+        .values(last_sync=when)
+    )
+
+
 @lru_cache
 def get_engine(filename="~/.config/dsync.sqlite"):
     """Get the SQLAlchemy Enginge interacting with the database (one per session)."""
     filename = op.abspath(op.expandvars(op.expanduser(filename)))
     database = "sqlite+pysqlite:///" + filename
-    engine = create_engine(database, echo=False, future=True)
+    engine = create_engine(
+        database,
+        echo=False,
+        future=True,
+        # Generous compiled-SQL cache so the handful of statements this
+        # application emits never get evicted.
+        query_cache_size=1200,
+        # A single shared connection suits SQLite's single-writer model and
+        # stops every new Session from re-opening the .db/.db-wal/.db-shm trio.
+        poolclass=StaticPool,
+        connect_args={"check_same_thread": False},
+    )
+
+    @event.listens_for(engine, "connect")
+    def _tune_sqlite(dbapi_connection, connection_record):
+        # WAL avoids the rollback-journal fsync on every commit and lets
+        # readers proceed alongside a writer; the remaining pragmas trade a
+        # little durability and memory for noticeably lower commit latency.
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA cache_size=-20000")
+        cursor.execute("PRAGMA mmap_size=134217728")
+        cursor.close()
 
     Base.metadata.create_all(engine)
+    _migrate_schema(engine)
     return engine
 
 
+def _migrate_schema(engine):
+    """
+    Bring databases created by older dsync versions up to date.
+
+    create_all only creates tables that are missing entirely, so columns
+    and indexes added to existing tables have to be applied here. SQLite
+    can add nullable columns in place, which covers every addition so far;
+    index creation is a no-op when the index already exists.
+    """
+    with engine.begin() as connection:
+        for table in Base.metadata.tables.values():
+            existing = {
+                row[1]
+                for row in connection.exec_driver_sql(
+                    f'PRAGMA table_info("{table.name}")'
+                )
+            }
+            for column in table.columns:
+                if column.name not in existing:
+                    connection.exec_driver_sql(
+                        f'ALTER TABLE "{table.name}" ADD COLUMN '
+                        f"{column.name} {column.type.compile(engine.dialect)}"
+                    )
+            # Checked by name through the PRAGMA: SQLAlchemy's own
+            # checkfirst cannot reflect the expression-based indexes.
+            existing_indexes = {
+                row[1]
+                for row in connection.exec_driver_sql(
+                    f'PRAGMA index_list("{table.name}")'
+                )
+            }
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    index.create(connection)
+
+
+# Session opened by the outermost @in_session call, reused by nested calls.
+_current_session = ContextVar("_current_session", default=None)
+
+
 def in_session(func):
     """Wrap functions that need to run in a database session."""
 
     @wraps(func)
     def wrapped(*args, database="~/.config/dsync.sqlite", session=None, **kwargs):
+        if session is None:
+            session = _current_session.get()
         if session is not None:
             return func(*args, session=session, **kwargs)
         engine = get_engine(database)
         with Session(engine) as session:
-            res = func(*args, session=session, **kwargs)
-            session.commit()
+            token = _current_session.set(session)
+            try:
+                res = func(*args, session=session, **kwargs)
+                session.commit()
+            finally:
+                _current_session.reset(token)
         return res
 
     return wrapped
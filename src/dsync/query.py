@@ -1,36 +1,47 @@
 """Collecting information from the database."""
+import json
+import os
 import os.path as op
+from pathlib import PurePath
 
-import rich
+from sqlalchemy import bindparam, func, select
+from sqlalchemy.orm import raiseload, selectinload
 
 from .models import Dataset, DataStore, ToSync, in_session
 
+# Root directory containing the local version of all datasets (computed once).
+_DATA_ROOT = PurePath(op.expanduser("~/Work/data"))
+
 
 def datasets(session, *args, **kwargs):
     """Return a list of all datasets."""
     return _get_data(session, Dataset, *args, **kwargs)
 
 
-def get_dataset(session, name=None, current_directory=None, verbose=True):
+def get_dataset(session, name=None, current_directory=None, verbose=True, load_syncs=False):
     """
     Return a specific dataset identified by name.
 
     If `name` is None, find return the dataset corresponding to the current directory instead.
     If the current directory is not in a dataset or
     if `name` does not match an existing dataset, returns None.
+    Set `load_syncs` to True to fetch the syncs (and their stores)
+    together with the dataset for callers that will iterate over them.
     """
     if name is None:
         if current_directory is None:
             current_directory = op.curdir
-        abs_dir = op.normpath(op.abspath(current_directory)).split(op.sep)
-        data_dir = op.expanduser("~/Work/data").split(op.sep)
-        if abs_dir[: len(data_dir)] == data_dir and len(abs_dir) > len(data_dir):
-            name = abs_dir[len(data_dir)]
+        path = PurePath(op.normpath(op.abspath(current_directory)))
+        if _DATA_ROOT in path.parents:
+            name = path.relative_to(_DATA_ROOT).parts[0]
             if verbose:
+                import rich
+
                 rich.print(f"Current dataset is determined to be {name}")
         else:
             return None
-    return session.query(Dataset).get(name)
+    options = (selectinload(Dataset.syncs),) if load_syncs else ()
+    return session.get(Dataset, name, options=options)
 
 
 def stores(session, *args, **kwargs):
@@ -38,41 +49,195 @@ def stores(session, *args, **kwargs):
     return _get_data(session, DataStore, *args, **kwargs)
 
 
-def _get_data(session, cls, name=None, as_list=False):
-    """Query the tables for datasets or data stores."""
+def _get_data(session, cls, name=None, as_list=False, options=(), criteria=()):
+    """
+    Query the tables for datasets or data stores.
+
+    Setting the DSYNC_STRICT_LOADING environment variable makes any
+    relationship access that is not covered by an eager load raise,
+    which catches accidental N+1 query regressions during development.
+    """
+    if os.environ.get("DSYNC_STRICT_LOADING", "0") != "0":
+        # The wildcard overrides the lazy="selectin" set on the mappings,
+        # so restate the intended eager load for the syncs collection.
+        options = (*options, selectinload(cls.syncs), raiseload("*"))
     if name is not None:
-        result = session.query(cls).get(name)
+        result = session.get(cls, name, options=options)
         if result is None:
             raise ValueError(f"Attempted to get non-existant {cls.__name__}: {name}.")
         if as_list:
             return [result]
         return result
-    return session.query(cls).all()
+    query = session.query(cls)
+    if len(options) > 0:
+        query = query.options(*options)
+    if len(criteria) > 0:
+        query = query.filter(*criteria)
+    return query.all()
+
+
+# Built once at import; SQLAlchemy then reuses the compiled SQL on every call.
+_LAST_SYNC_STMT = select(ToSync.last_sync).where(
+    ToSync.dataset_name == bindparam("dataset_name"),
+    ToSync.store_name == bindparam("store_name"),
+)
+
+
+def bulk_last_sync(session):
+    """
+    Return dictionary from (dataset name, store name) to the datetime of the last sync.
+
+    Pairs that are being synced but have not been synced yet map to "upcoming".
+    The result is cached on the session, so that `last_sync` calls in a
+    loop cost a single SELECT rather than one per (dataset, store) pair.
+    """
+    if "last_sync_cache" not in session.info:
+        rows = session.execute(
+            select(ToSync.dataset_name, ToSync.store_name, ToSync.last_sync)
+        ).all()
+        session.info["last_sync_cache"] = {
+            (dataset, store): ("upcoming" if when is None else when)
+            for dataset, store, when in rows
+        }
+    return session.info["last_sync_cache"]
 
 
 def last_sync(dataset, data_store, session):
     """Find the datetime of the last sync (None if never synced or not syncing anymore)."""
-    if isinstance(dataset, Dataset):
-        dataset = dataset.name
     if isinstance(data_store, DataStore):
         data_store = data_store.name
-    to_sync = session.query(ToSync).get((dataset, data_store))
-    return (
-        None
-        if to_sync is None
-        else ("upcoming" if to_sync.last_sync is None else to_sync.last_sync)
-    )
+    cache = session.info.get("last_sync_cache")
+    if cache is not None:
+        name = dataset.name if isinstance(dataset, Dataset) else dataset
+        return cache.get((name, data_store))
+    if isinstance(dataset, Dataset):
+        to_sync = dataset.syncs_by_store.get(data_store)
+        row = None if to_sync is None else (to_sync.last_sync,)
+    else:
+        row = session.execute(
+            _LAST_SYNC_STMT, {"dataset_name": dataset, "store_name": data_store}
+        ).one_or_none()
+    return None if row is None else ("upcoming" if row[0] is None else row[0])
+
+
+# Completion fires on every tab press; build the statements once at import so
+# only parameter binding and execution remain per call.
+_COMPLETE_DATASETS_STMT = select(Dataset.name).where(
+    Dataset.archived == bindparam("archived"),
+    func.lower(Dataset.name).like(bindparam("prefix")),
+)
+_COMPLETE_STORES_STMT = select(DataStore.name).where(
+    func.lower(DataStore.name).like(bindparam("prefix"))
+)
+_COMPLETE_REMOTES_STMT = _COMPLETE_STORES_STMT.where(DataStore.is_archive.is_not(True))
+
+# On-disc cache of all dataset/store names, so most tab presses do not
+# need to open the database at all.
+_COMPLETION_CACHE = op.expanduser("~/.cache/dsync/completions.json")
+
+
+def _database_mtime(database):
+    """Return the time of the last write to the database (including its WAL)."""
+    database = op.abspath(op.expandvars(op.expanduser(database)))
+    mtimes = []
+    for path in (database, database + "-wal"):
+        try:
+            mtimes.append(os.stat(path).st_mtime)
+        except OSError:
+            continue
+    return max(mtimes, default=None)
+
+
+def _load_completion_cache(database):
+    """Load the cached completion names (None if missing or older than the database)."""
+    db_mtime = _database_mtime(database)
+    try:
+        if db_mtime is None or os.stat(_COMPLETION_CACHE).st_mtime < db_mtime:
+            return None
+        with open(_COMPLETION_CACHE) as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError):
+        return None
+
+
+def invalidate_completion_cache():
+    """
+    Remove the on-disc completion cache.
+
+    Mutating commands call this directly: the mtime comparison against the
+    database usually catches changes on its own, but its one-second
+    resolution can leave a just-written cache looking current.
+    """
+    try:
+        os.unlink(_COMPLETION_CACHE)
+    except FileNotFoundError:
+        pass
+
+
+def _refresh_completion_cache(session):
+    """Write all dataset/store names to disc for future shell completion calls."""
+    content = {
+        "datasets": [
+            [name, name.lower(), bool(archived)]
+            for name, archived in session.execute(
+                select(Dataset.name, Dataset.archived)
+            )
+        ],
+        "stores": [
+            [name, name.lower(), bool(is_archive)]
+            for name, is_archive in session.execute(
+                select(DataStore.name, DataStore.is_archive)
+            )
+        ],
+    }
+    os.makedirs(op.dirname(_COMPLETION_CACHE), exist_ok=True)
+    tmp_path = _COMPLETION_CACHE + ".tmp"
+    with open(tmp_path, "w") as cache_file:
+        json.dump(content, cache_file)
+    os.replace(tmp_path, _COMPLETION_CACHE)
 
 
 @in_session
-def complete_datasets(ctx, param, incomplete, session, archived=False):
-    """Provide shell completion for datasets."""
-    all_names = [d.name for d in datasets(session) if archived == d.archived]
-    return [n for n in all_names if n.lower().startswith(incomplete.lower())]
+def _complete_datasets_db(incomplete, session, archived=False):
+    """Query matching dataset names and refresh the on-disc completion cache."""
+    _refresh_completion_cache(session)
+    params = {"archived": archived, "prefix": incomplete.lower() + "%"}
+    return session.execute(_COMPLETE_DATASETS_STMT, params).scalars().all()
 
 
 @in_session
-def complete_stores(ctx, param, incomplete, session, only_remotes=False):
+def _complete_stores_db(incomplete, session, only_remotes=False):
+    """Query matching store names and refresh the on-disc completion cache."""
+    _refresh_completion_cache(session)
+    stmt = _COMPLETE_REMOTES_STMT if only_remotes else _COMPLETE_STORES_STMT
+    return session.execute(stmt, {"prefix": incomplete.lower() + "%"}).scalars().all()
+
+
+def complete_datasets(
+    ctx, param, incomplete, database="~/.config/dsync.sqlite", archived=False
+):
+    """Provide shell completion for datasets."""
+    cached = _load_completion_cache(database)
+    if cached is not None:
+        inc = incomplete.lower()
+        return [
+            name
+            for name, lowered, is_archived in cached["datasets"]
+            if is_archived == archived and lowered.startswith(inc)
+        ]
+    return _complete_datasets_db(incomplete, database=database, archived=archived)
+
+
+def complete_stores(
+    ctx, param, incomplete, database="~/.config/dsync.sqlite", only_remotes=False
+):
     """Provide shell completion for data stores."""
-    all_names = [s.name for s in stores(session) if not (only_remotes and s.is_archive)]
-    return [n for n in all_names if n.lower().startswith(incomplete.lower())]
+    cached = _load_completion_cache(database)
+    if cached is not None:
+        inc = incomplete.lower()
+        return [
+            name
+            for name, lowered, is_archive in cached["stores"]
+            if not (only_remotes and is_archive) and lowered.startswith(inc)
+        ]
+    return _complete_stores_db(incomplete, database=database, only_remotes=only_remotes)
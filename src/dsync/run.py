@@ -1,20 +1,34 @@
 """CLI interface for dsync."""
 import os.path as op
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from functools import partial
 
 import click
-import rich
-from rich.table import Table
-
-from .models import Dataset, DataStore, ToSync, in_session
+from sqlalchemy import case, insert, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import joinedload
+
+from .dry_run import dry_run
+from .models import (
+    Dataset,
+    DataStore,
+    ToSync,
+    get_connections,
+    in_session,
+    sync_datasets,
+)
 from .query import (
+    bulk_last_sync,
     complete_datasets,
     complete_stores,
     datasets,
     get_dataset,
+    invalidate_completion_cache,
     last_sync,
     stores,
 )
+from .transfer import set_default_bwlimit
 
 
 @click.group
@@ -47,17 +61,31 @@ def add_dataset(name, description, session, primary=None):
     if primary is None and not op.isdir(new_dataset.local_path):
         raise ValueError("Cannot start syncing a dataset that does not exist locally.")
     session.add(new_dataset)
+    invalidate_completion_cache()
     if primary is not None:
         add_sync.callback(new_dataset.name, primary.name, session=session)
 
 
 @cli.command
-@click.argument("name")
+@click.argument("name", required=False, default=None)
 @click.option("-t", "--type", default="ssh", show_default=True)
 @click.option("-l", "--link")
-def add_remote(name, type="ssh", link=None):
-    """Add remote to database."""
-    add_data_store(name, type, False, link)
+@click.option("-f", "--from-file", type=click.Path(exists=True))
+def add_remote(name, type="ssh", link=None, from_file=None):
+    """Add remote (or all remotes listed in a file) to database."""
+    if from_file is not None:
+        with open(from_file) as remote_file:
+            names = [line.strip() for line in remote_file if line.strip() != ""]
+        add_data_stores(
+            [
+                {"name": n, "link": n, "type": type, "is_archive": False}
+                for n in names
+            ]
+        )
+    elif name is None:
+        raise ValueError("Please provide a remote name or -f/--from-file.")
+    else:
+        add_data_store(name, type, False, link)
 
 
 @cli.command
@@ -78,6 +106,19 @@ def add_data_store(name, type, is_archive, link, session):
         raise ValueError(f"Data store type should be one of disc/ssh, not {type}")
     new_remote = DataStore(name=name, link=link, type=type, is_archive=is_archive)
     session.add(new_remote)
+    invalidate_completion_cache()
+
+
+@in_session
+def add_data_stores(rows, session):
+    """Add multiple data stores to database with a single bulk INSERT."""
+    for row in rows:
+        if row["type"] not in ("disc", "ssh"):
+            raise ValueError(
+                f"Data store type should be one of disc/ssh, not {row['type']}"
+            )
+    session.execute(insert(DataStore), rows)
+    invalidate_completion_cache()
 
 
 @cli.command
@@ -86,7 +127,7 @@ def add_data_store(name, type, is_archive, link, session):
 @in_session
 def add_sync(dataset, remote, session):
     """Instruct dsync to sync dataset with remote from now on."""
-    remote_obj = session.query(DataStore).get(remote)
+    remote_obj = session.get(DataStore, remote)
     if remote_obj is None:
         raise ValueError(
             f"Unrecognised remote: {remote}. Create new remote using add-remote."
@@ -101,12 +142,18 @@ def add_sync(dataset, remote, session):
         raise ValueError(
             f"Unrecognised dataset: {dataset}. Create new dataset using add-dataset."
         )
-    sync_obj = session.query(ToSync).get((dataset, remote))
-    if sync_obj is not None:
-        click.echo(f"{dataset} is already syncing to {remote}")
+    # Single INSERT .. ON CONFLICT DO NOTHING instead of an existence
+    # check followed by an INSERT.
+    stmt = (
+        sqlite_insert(ToSync)
+        .values(dataset_name=dataset_obj.name, store_name=remote)
+        .on_conflict_do_nothing()
+    )
+    if session.execute(stmt).rowcount == 0:
+        click.echo(f"{dataset_obj.name} is already syncing to {remote}")
     else:
-        session.add(ToSync(dataset=dataset_obj, store=remote_obj))
-    sync.callback(session=session, dataset=dataset, store=remote)
+        session.expire(dataset_obj, ["syncs"])
+    sync.callback(session=session, dataset=dataset_obj.name, store=remote)
 
 
 @cli.command
@@ -141,6 +188,8 @@ def set_primary(dataset, primary, session, skip_sync=False):
                 f"Primary cannot be set to an archive data store, such as {primary}."
             )
     if dataset.primary == primary:
+        import rich
+
         rich.print("New primary is the same as the old one. Doing nothing...")
         return
 
@@ -159,9 +208,19 @@ def set_primary(dataset, primary, session, skip_sync=False):
 @in_session
 def list(session):
     """List the datasets to stdout."""
-    for dataset in datasets(session):
-        if not dataset.archived:
-            print(dataset.name)
+    stmt = select(Dataset.name).where(Dataset.archived.is_not(True))
+    for name in session.execute(stmt).scalars():
+        print(name)
+
+
+@cli.command
+@in_session
+def refresh(session):
+    """Refresh the stored time of the latest edit of every local dataset."""
+    active = datasets(session, criteria=(Dataset.archived.is_not(True),))
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        for _ in executor.map(Dataset.update_latest_edit, active):
+            pass
 
 
 @cli.command
@@ -171,7 +230,7 @@ def list(session):
 @in_session
 def get_remotes(dataset, session):
     """Print the primary of given dataset to stdout."""
-    obj = get_dataset(session, name=dataset, verbose=False)
+    obj = get_dataset(session, name=dataset, verbose=False, load_syncs=True)
     if obj is None:
         if dataset is None:
             raise ValueError(
@@ -205,6 +264,9 @@ def summary(session, test=False):
 
 def summary_stores(session):
     """List all data stores (remotes & archives)."""
+    import rich
+    from rich.table import Table
+
     remotes = Table(title="Remote data stores")
     for header in ("name", "link", "works"):
         remotes.add_column(header)
@@ -212,9 +274,10 @@ def summary_stores(session):
     for header in ("name", "directory", "works"):
         archives.add_column(header)
 
-    for store in stores(session=session):
-        link = store.get_connection()
-        works = "❌" if link is None else "✅︎"
+    all_stores = stores(session=session)
+    links = get_connections(all_stores)
+    for store in all_stores:
+        works = "❌" if links[store.name] is None else "✅︎"
         if store.is_archive:
             archives.add_row(store.name, store.link, works)
         else:
@@ -225,25 +288,45 @@ def summary_stores(session):
 
 def summary_datasets(session):
     """List all datasets."""
+    import rich
+    from rich.table import Table
+
+    bulk_last_sync(session)
     all_stores = stores(session)
     all_datasets = sorted(
-        sorted(datasets(session), key=lambda d: d.name), key=lambda d: d.archived
+        sorted(
+            datasets(session, options=(joinedload(Dataset.primary),)),
+            key=lambda d: d.name,
+        ),
+        key=lambda d: d.archived,
     )
 
     table = Table(title="Datasets")
     for header in ("name", "primary", "latest edit", "local"):
-        table.add_column(header)
+        table.add_column(header, no_wrap=True)
     for store in all_stores:
-        table.add_column(store.name)
-
+        table.add_column(store.name, no_wrap=True)
+
+    # Refresh the edit times of all active datasets up front; the directory
+    # walks are IO-bound, so batching them in one pool keeps the filesystem
+    # out of the row-building loop (archived datasets keep their stored time).
+    active = [dataset for dataset in all_datasets if not dataset.archived]
+    if len(active) > 0:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            for _ in executor.map(Dataset.refresh_latest_edit, active):
+                pass
+
+    rows = []
     for dataset in all_datasets:
         if dataset.archived:
-            row = [
-                dataset.name,
-                "📁",
-                dataset.latest_edit.strftime("%Y-%m-%d %H:%M"),
-            ] + [""] * (len(all_stores) + 1)
-            table.add_row(*row)
+            rows.append(
+                [
+                    dataset.name,
+                    "📁",
+                    dataset.latest_edit.strftime("%Y-%m-%d %H:%M"),
+                ]
+                + [""] * (len(all_stores) + 1)
+            )
             continue
 
         row = [dataset.name]
@@ -258,7 +341,6 @@ def summary_datasets(session):
                     ls if isinstance(ls, str) else ls.strftime("%Y-%m-%d %H:%M"),
                 ]
             )
-        dataset.update_latest_edit()
         row.insert(2, dataset.latest_edit.strftime("%Y-%m-%d %H:%M"))
 
         for store in all_stores:
@@ -271,31 +353,78 @@ def summary_datasets(session):
                     if ls is None
                     else (ls if isinstance(ls, str) else ls.strftime("%Y-%m-%d %H:%M"))
                 )
-        table.add_row(*row)
+        rows.append(row)
 
+    for row in rows:
+        table.add_row(*row)
     rich.print(table)
 
 
 @cli.command
 @click.option("-d", "--dataset", shell_complete=complete_datasets)
 @click.option("-s", "--store", shell_complete=complete_stores)
+@click.option("-n", "--dry-run", "dryrun", is_flag=True, default=False)
+@click.option("-v", "--verbose", is_flag=True, default=False)
+@click.option(
+    "-b",
+    "--bwlimit",
+    type=int,
+    default=None,
+    help="Bandwidth cap for ssh transfers in KiB/s (0 for unlimited).",
+)
+@click.option(
+    "-p",
+    "--parallel",
+    "workers",
+    type=int,
+    default=None,
+    help="Shard each dataset's transfer over this many concurrent rsyncs.",
+)
 @in_session
-def sync(session, dataset=None, store=None):
+def sync(
+    session,
+    dataset=None,
+    store=None,
+    dryrun=False,
+    verbose=False,
+    bwlimit=None,
+    workers=None,
+):
     """Sync any dataset to any remote."""
+    if bwlimit is not None:
+        set_default_bwlimit(None if bwlimit == 0 else bwlimit)
     all_datasets = [get_dataset(session, dataset)]
     if all_datasets[0] is None:
         if dataset is not None:
             raise ValueError(f"Trying to sync unknown dataset '{dataset}'")
-        all_datasets = datasets(session)
+        # One round-trip for the datasets and their primaries; the syncs
+        # (and their stores) already come along via the selectin relationship.
+        # Archived datasets cannot be synced, so filter them out in SQL.
+        all_datasets = datasets(
+            session,
+            options=(joinedload(Dataset.primary),),
+            criteria=(Dataset.archived.is_not(True),),
+        )
 
-    for ds_iter in all_datasets:
-        try:
-            rc = ds_iter.sync(session, store)
-            if rc != 0:
-                raise ValueError(f"Failed to sync {ds_iter}")
-        except ValueError:
-            if len(all_datasets) == 1:
-                raise
+    if len(all_datasets) > 1:
+        # Probe every store up front in parallel; the per-store results are
+        # cached, so the serial syncs below find their connections ready.
+        get_connections(stores(session))
+
+    with dry_run() if dryrun else nullcontext():
+        if store is None and len(all_datasets) > 1 and workers is None:
+            # Group the transfers per store, so every remote gets a single
+            # batch of rsync commands instead of one connection per dataset.
+            sync_datasets(session, all_datasets, verbose=verbose)
+            return
+        for ds_iter in all_datasets:
+            try:
+                rc = ds_iter.sync(session, store, verbose=verbose, workers=workers)
+                if rc != 0:
+                    raise ValueError(f"Failed to sync {ds_iter}")
+            except ValueError:
+                if len(all_datasets) == 1:
+                    raise
 
 
 @cli.command
@@ -307,7 +436,7 @@ def archive(dataset, session):
 
     It will no longer be synced and can be safely deleted from other machines.
     """
-    dataset_obj = get_dataset(session, name=dataset)
+    dataset_obj = get_dataset(session, name=dataset, load_syncs=True)
     if dataset_obj.archived:
         raise ValueError(f"Dataset '{dataset_obj.name}' is already archived.")
     if dataset_obj.primary is not None:
@@ -322,8 +451,11 @@ def archive(dataset, session):
                 f"because sync to store '{sync_obj.store.name}' is not up to date. "
                 "Please run `dsync sync` with that remote/archive available."
             )
+    import rich
+
     rich.print("archiving", dataset_obj)
     dataset_obj.archived = True
+    invalidate_completion_cache()
 
 
 @cli.command
@@ -341,9 +473,24 @@ def unarchive(dataset, session):
     if not dataset_obj.archived:
         raise ValueError(f"Dataset '{dataset_obj.name}' is not archived already.")
 
-    for store in stores(session):
-        if not store.is_archive:
-            continue
+    # Probe the most promising archive first: a mounted disc costs one stat
+    # (no ssh handshake) and the most recently synced copy is the freshest.
+    candidates = (
+        session.query(DataStore)
+        .join(ToSync, ToSync.store_name == DataStore.name)
+        .filter(
+            DataStore.is_archive.is_(True), ToSync.dataset_name == dataset_obj.name
+        )
+        .order_by(
+            case({"disc": 0, "ssh": 1}, value=DataStore.type, else_=2),
+            ToSync.last_sync.desc(),
+        )
+        .all()
+    )
+    if len(candidates) == 0:
+        # No sync records (e.g. older databases); fall back to every archive.
+        candidates = [store for store in stores(session) if store.is_archive]
+    for store in candidates:
         link = store.get_connection()
         if link is None:
             continue
@@ -352,9 +499,12 @@ def unarchive(dataset, session):
     else:
         raise ValueError(f"Could not retrieve '{dataset_obj.name}' from archive.")
 
+    import rich
+
     rich.print("unarchiving", dataset_obj)
     dataset_obj.archived = False
     dataset_obj.primary = None
+    invalidate_completion_cache()
 
 
 @cli.command
@@ -402,8 +552,11 @@ def transfer_specific_files(paths, store, from_local, session):  # noqa: C901
             f"Dataset '{dataset.name}' is archived. "
             "Please run `dsync unarchive` before transfering data."
         )
+    # A prefix check against the dataset directory replaces one database
+    # lookup per extra path; only paths[0] needs the full resolution above.
+    prefix = op.realpath(dataset.local_path) + op.sep
     for path in paths[1:]:
-        if dataset != get_dataset(session, current_directory=path, verbose=False):
+        if not op.realpath(op.abspath(path)).startswith(prefix):
             raise ValueError("Not all requested paths are in the same dataset.")
 
     if store is None:
@@ -417,20 +570,29 @@ def transfer_specific_files(paths, store, from_local, session):  # noqa: C901
         store = stores(session, name=store)
 
     if not store.is_archive:
-        sync_obj = session.query(ToSync).get((dataset.name, store.name))
-        if sync_obj is None:
+        # Only existence matters here; fetch a single column rather than
+        # hydrating the full ToSync row.
+        syncing = session.execute(
+            select(ToSync.dataset_name).filter_by(
+                dataset_name=dataset.name, store_name=store.name
+            )
+        ).first()
+        if syncing is None:
+            import rich
+
             rich.print(f"Sending data to unsynced remote {store.name}")
 
     connection = store.get_connection()
     if connection is None:
         raise ValueError(f"Unable to set up connection to {store.name}.")
 
+    # Constant for the whole call; expanduser hits the environment each time.
+    base = op.expanduser(f"~/Work/data/{dataset.name}")
     for path in paths:
-        relpath = op.relpath(
-            op.abspath(path), op.expanduser(f"~/Work/data/{dataset.name}")
-        )
-        if (op.exists(path) and op.isdir(path)) or (  # I know it is a path
-            not op.exists(path) and path.endswith("/")  # User told me its a path
+        relpath = op.relpath(op.abspath(path), base)
+        exists = op.exists(path)
+        if (exists and op.isdir(path)) or (  # I know it is a path
+            not exists and path.endswith("/")  # User told me its a path
         ):
             relpath = relpath + "/"
         connection.sync(dataset.name, relpath, from_local=from_local)